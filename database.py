@@ -5,7 +5,9 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
+from bson import ObjectId
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
@@ -22,12 +24,24 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=200,
+        minPoolSize=20,
+        waitQueueTimeoutMS=2000,
+        serverSelectionTimeoutMS=3000,
+        connectTimeoutMS=2000,
+        retryReads=True,
+        retryWrites=True,
+        # zstd needs the zstandard package (in requirements); zlib is built in.
+        # The server picks the first one it also supports.
+        compressors="zstd,zlib",
+    )
     db = _client[database_name]
 
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
-    """Insert a single document with timestamp"""
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
+    """Insert a single document with server-side timestamps"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
@@ -37,13 +51,45 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    # Timestamps come from the server clock; payloads are already validated by Pydantic
+    data_dict.pop('created_at', None)
+    data_dict.pop('updated_at', None)
+    doc_id = data_dict.pop('_id', None) or ObjectId()
 
-    result = db[collection_name].insert_one(data_dict)
-    return str(result.inserted_id)
+    await db[collection_name].update_one(
+        {"_id": doc_id},
+        {"$setOnInsert": data_dict, "$currentDate": {"created_at": True, "updated_at": True}},
+        upsert=True,
+        bypass_document_validation=True,
+    )
+    return str(doc_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def insert_if_absent(collection_name: str, key: dict, data: Union[BaseModel, dict]):
+    """Insert a document with timestamps unless one matching key exists; return its id"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    if isinstance(data, BaseModel):
+        data_dict = data.model_dump()
+    else:
+        data_dict = data.copy()
+
+    # Not $currentDate: that would also bump updated_at on an existing match
+    data_dict['created_at'] = data_dict['updated_at'] = datetime.now(timezone.utc)
+
+    try:
+        result = await db[collection_name].update_one(
+            key, {"$setOnInsert": data_dict}, upsert=True, bypass_document_validation=True
+        )
+        if result.upserted_id is not None:
+            return str(result.upserted_id)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent insert of the same key
+        pass
+    existing = await db[collection_name].find_one(key, {"_id": 1})
+    return str(existing["_id"])
+
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -52,4 +98,4 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=None)
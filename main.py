@@ -1,19 +1,79 @@
+import asyncio
+import base64
+import json
 import os
+import logging
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime
 from typing import List, Optional, Dict, Any
+import orjson
+from cachetools import TTLCache
 from fastapi import FastAPI, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, GetCoreSchemaHandler, GetJsonSchemaHandler
+from pydantic_core import core_schema
 from bson import ObjectId
-
-from database import db, create_document, get_documents
-from schemas import Product, Listing, Offer, Order
-
-app = FastAPI(title="SneakSync Marketplace API")
+from bson.errors import InvalidId
+from bson.regex import Regex
+from pymongo import ReturnDocument
+from pymongo.errors import ConnectionFailure, ExecutionTimeout, OperationFailure, PyMongoError
+
+from database import db, create_document, get_documents, insert_if_absent
+from schemas import Product, Listing, Offer, Order, ShippingOption, LISTING_STATUS_CODES, PRODUCT_CONDITION_CODES
+
+logger = logging.getLogger(__name__)
+
+# Server error code for "text index required for $text query"
+INDEX_NOT_FOUND = 27
+
+# (keys, options) for the product indexes the endpoints rely on
+PRODUCT_INDEXES: List[Any] = [
+    # Partial, not sparse: products with a blank slug ("") must not collide
+    ("slug", {"unique": True, "partialFilterExpression": {"slug": {"$type": "string", "$gt": ""}}}),
+    (
+        [("title", "text"), ("brand", "text"), ("model", "text")],
+        {"weights": {"title": 10, "brand": 5, "model": 5}, "name": "product_text"},
+    ),
+    # ESR order: equality filters first, then the (created_at, _id) sort/cursor key
+    ([("brand_lc", 1), ("condition", 1), ("created_at", -1), ("_id", -1)], {}),
+    ([("available_sizes", 1), ("created_at", -1), ("_id", -1)], {}),
+    ([("created_at", -1), ("_id", -1)], {}),
+]
+
+
+async def ensure_indexes():
+    # Best effort: the API must still boot (and answer /test) without Mongo
+    for keys, options in PRODUCT_INDEXES:
+        try:
+            await db["product"].create_index(keys, **options)
+        except ConnectionFailure as e:
+            logger.warning("Skipping index creation, database unreachable: %s", e)
+            return
+        except PyMongoError as e:
+            logger.warning("Could not create product index %s: %s", keys, e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build indexes in the background so startup never waits on the database
+    task = asyncio.create_task(ensure_indexes()) if db is not None else None
+    yield
+    if task is not None:
+        task.cancel()
+
+
+app = FastAPI(title="SneakSync Marketplace API", lifespan=lifespan)
+
+# Comma-separated, e.g. "https://sneaksync.app,http://localhost:3000"
+ALLOWED_ORIGINS = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=ALLOWED_ORIGINS or ["*"],
+    # Credentialed requests only for an explicit allow-list, never for "*"
+    allow_credentials=bool(ALLOWED_ORIGINS),
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -22,85 +82,191 @@ app.add_middleware(
 # ----- Helpers -----
 class PyObjectId(ObjectId):
     @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
+    def __get_pydantic_core_schema__(cls, source: Any, handler: GetCoreSchemaHandler):
+        return core_schema.no_info_plain_validator_function(
+            cls.validate, serialization=core_schema.to_string_ser_schema()
+        )
+
+    @classmethod
+    def __get_pydantic_json_schema__(cls, schema: Any, handler: GetJsonSchemaHandler):
+        return {"type": "string", "pattern": "^[0-9a-fA-F]{24}$"}
 
     @classmethod
     def validate(cls, v):
         if isinstance(v, ObjectId):
             return v
-        if not ObjectId.is_valid(v):
+        if v is None:
+            # ObjectId(None) would mint a fresh id rather than fail
             raise ValueError("Invalid ObjectId")
-        return ObjectId(v)
-
-def serialize_doc(doc: Dict[str, Any]):
-    if not doc:
-        return doc
-    doc = dict(doc)
-    _id = doc.pop("_id", None)
-    if _id is not None:
-        doc["id"] = str(_id)
-    # Convert any nested ObjectIds (best-effort)
-    for k, v in list(doc.items()):
-        if isinstance(v, ObjectId):
-            doc[k] = str(v)
-        if isinstance(v, list):
-            doc[k] = [str(x) if isinstance(x, ObjectId) else x for x in v]
-        if isinstance(v, dict):
-            for nk, nv in list(v.items()):
-                if isinstance(nv, ObjectId):
-                    v[nk] = str(nv)
-    return doc
+        try:
+            return ObjectId(v)
+        except (InvalidId, TypeError):
+            raise ValueError("Invalid ObjectId")
+
+def _orjson_default(obj: Any):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+class MongoJSONResponse(ORJSONResponse):
+    """Encodes raw Mongo documents (ObjectIds included) straight to JSON via orjson"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Rendered /products bodies keyed by query params; per-process, cleared on writes.
+# Multi-worker deployments should move this to Redis with the same keys.
+products_cache: TTLCache = TTLCache(maxsize=1024, ttl=10)
+
+# Fields the product grid renders; everything else stays on the server
+PRODUCT_LIST_PROJECTION: Dict[str, Any] = {
+    "title": 1,
+    "brand": 1,
+    "slug": 1,
+    "images": {"$slice": 1},
+    "created_at": 1,
+    "size_variants.price": 1,
+    "size_variants.currency": 1,
+}
+PRODUCT_SEARCH_PROJECTION: Dict[str, Any] = {**PRODUCT_LIST_PROJECTION, "score": {"$meta": "textScore"}}
+
+def item_serializer(projection: Dict[str, Any]):
+    """Build a serializer that reads exactly the projection's top-level fields"""
+    fields = tuple(dict.fromkeys(k.split(".", 1)[0] for k in projection if k != "_id"))
+    return lambda d: {"id": d["_id"], **{f: d.get(f) for f in fields}}
+
+# Field lists are resolved once at import and follow any edit to the projections above
+serialize_list_item = item_serializer(PRODUCT_LIST_PROJECTION)
+serialize_search_item = item_serializer(PRODUCT_SEARCH_PROJECTION)
+
+def encode_cursor(doc: Dict[str, Any]) -> str:
+    raw = json.dumps({"created_at": doc["created_at"].isoformat(), "_id": str(doc["_id"])})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(raw["created_at"]), ObjectId(raw["_id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "SneakSync Marketplace API is running"}
 
 
 # ----- Products -----
-@app.get("/products")
-def list_products(
+@app.get("/products", response_class=MongoJSONResponse)
+async def list_products(
     q: Optional[str] = Query(None, description="Search query across title/brand/model"),
     brand: Optional[str] = None,
     size: Optional[str] = None,
     condition: Optional[str] = None,
     page: int = Query(1, ge=1),
     per_page: int = Query(12, ge=1, le=100),
+    with_total: bool = Query(False, description="Include a total count (slower on large filtered queries)"),
+    after: Optional[str] = Query(None, description="Opaque next_cursor from the previous page; replaces page"),
 ):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
+    if after and q:
+        # Relevance-ranked search has no stable (created_at, _id) order to resume from
+        raise HTTPException(status_code=400, detail="Cursor pagination is not supported with q")
+
+    cache_key = (q, brand.lower().strip() if brand else None, size, condition, page, per_page, with_total, after)
+    cached = products_cache.get(cache_key)
+    if cached is not None:
+        return Response(cached, media_type="application/json")
 
     filter_q: Dict[str, Any] = {}
 
     if q:
-        filter_q["$or"] = [
-            {"title": {"$regex": q, "$options": "i"}},
-            {"brand": {"$regex": q, "$options": "i"}},
-            {"model": {"$regex": q, "$options": "i"}},
-        ]
+        filter_q["$text"] = {"$search": q}
     if brand:
-        filter_q["brand"] = {"$regex": f"^{brand}$", "$options": "i"}
+        filter_q["brand_lc"] = brand.lower().strip()
     if condition:
-        filter_q["condition"] = condition
+        if condition not in PRODUCT_CONDITION_CODES:
+            raise HTTPException(status_code=400, detail="Unknown condition")
+        # Also match the string form until migrate.py has converted older products
+        filter_q["condition"] = {"$in": [PRODUCT_CONDITION_CODES[condition], condition]}
     if size:
-        filter_q["size_variants.size"] = size
-
-    total = db["product"].count_documents(filter_q)
-    cursor = (
-        db["product"].find(filter_q)
-        .sort("created_at", -1)
-        .skip((page - 1) * per_page)
-        .limit(per_page)
-    )
+        filter_q["available_sizes"] = size
 
-    items = [serialize_doc(d) for d in cursor]
-    return {
-        "total": total,
+    projection = PRODUCT_LIST_PROJECTION
+    sort: List[Any] = [("created_at", -1), ("_id", -1)]
+    if q:
+        projection = PRODUCT_SEARCH_PROJECTION
+        sort = [("score", {"$meta": "textScore"}), ("created_at", -1), ("_id", -1)]
+
+    page_q: Dict[str, Any] = {}
+    if after:
+        cur_ts, cur_id = decode_cursor(after)
+        page_q["$and"] = [{"$or": [
+            {"created_at": {"$lt": cur_ts}},
+            {"created_at": cur_ts, "_id": {"$lt": cur_id}},
+        ]}]
+
+    async def fetch_page():
+        cursor = db["product"].find({**filter_q, **page_q}, projection).sort(sort)
+        if not after:
+            cursor = cursor.skip((page - 1) * per_page)
+        return await cursor.limit(per_page).to_list(length=per_page)
+
+    async def run_queries():
+        if not with_total:
+            return await fetch_page(), None
+        # Independent queries: overlap the count with the page fetch
+        results = await asyncio.gather(
+            fetch_page(), count_products(filter_q, first_page=page == 1 and not after), return_exceptions=True
+        )
+        for r in results:
+            if isinstance(r, BaseException):
+                raise r
+        return results
+
+    try:
+        docs, total = await run_queries()
+    except OperationFailure as e:
+        if not q or e.code != INDEX_NOT_FOUND:
+            raise
+        # No text index (e.g. not yet built): fall back to a regex scan
+        logger.warning("Text index missing, falling back to regex search: %s", e)
+        del filter_q["$text"]
+        pattern = Regex(re.escape(q), "i")
+        filter_q["$or"] = [{"title": pattern}, {"brand": pattern}, {"model": pattern}]
+        projection = PRODUCT_LIST_PROJECTION
+        sort = [("created_at", -1), ("_id", -1)]
+        docs, total = await run_queries()
+
+    has_more = len(docs) == per_page
+    next_cursor = encode_cursor(docs[-1]) if has_more and not q else None
+    serialize_item = serialize_search_item if projection is PRODUCT_SEARCH_PROJECTION else serialize_list_item
+    response: Dict[str, Any] = {
         "page": page,
         "per_page": per_page,
-        "items": items,
+        "has_more": has_more,
+        "next_cursor": next_cursor,
+        "items": [serialize_item(d) for d in docs],
     }
+    if with_total:
+        response["total"] = total
+    rendered = MongoJSONResponse(response)
+    products_cache[cache_key] = rendered.body
+    return rendered
+
+
+async def count_products(filter_q: Dict[str, Any], first_page: bool) -> Optional[int]:
+    if not filter_q:
+        # Collection metadata, no scan
+        return await db["product"].estimated_document_count()
+    # Give the first page a real budget; deeper pages (including every cursor
+    # page, which leaves page at its default) shouldn't wait on a slow count
+    max_time_ms = 5000 if first_page else 100
+    try:
+        return await db["product"].count_documents(filter_q, maxTimeMS=max_time_ms)
+    except ExecutionTimeout:
+        return None
 
 
 # ----- Listings -----
@@ -112,97 +278,134 @@ class ListingCreate(BaseModel):
 
 
 @app.post("/listings")
-def create_listing(payload: ListingCreate):
+async def create_listing(payload: ListingCreate):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
-    # Upsert product (by slug if provided, else insert new)
-    product_data = payload.product.model_dump()
-    existing = None
-    if product_data.get("slug"):
-        existing = db["product"].find_one({"slug": product_data["slug"]})
-
-    if existing:
-        product_id = str(existing["._id"]) if "._id" in existing else str(existing["_id"])  # safety
-    else:
-        product_id = create_document("product", product_data)
+    product_data = payload.product.model_dump(exclude_none=True)
+    product_data["brand_lc"] = product_data["brand"].lower().strip()
+    product_data["available_sizes"] = sorted({v["size"] for v in product_data["size_variants"]})
+    new_product_id = ObjectId()
 
+    # Validate the listing before touching the database
     listing = Listing(
         seller_id=payload.seller_id,
-        product_id=product_id,
+        product_id=str(new_product_id),
         price=payload.price,
-        listing_type=payload.listing_type,  # validated by schema on DB write
+        listing_type=payload.listing_type,
     )
 
-    listing_id = create_document("listing", listing)
+    # Reuse the product by slug if it exists, else insert new
+    slug = product_data.get("slug")
+    existing = await db["product"].find_one({"slug": slug}, {"_id": 1}) if slug else None
+    if existing:
+        product_id = str(existing["_id"])
+        listing.product_id = product_id
+        listing_id = await create_document("listing", listing)
+    else:
+        # New product: its id is assigned here, so both documents can be written in parallel
+        product_data["_id"] = new_product_id
+        if slug:
+            product_write = insert_if_absent("product", {"slug": slug}, product_data)
+        else:
+            product_write = create_document("product", product_data)
+        product_id, listing_id = await asyncio.gather(
+            product_write, create_document("listing", listing), return_exceptions=True
+        )
+        if isinstance(listing_id, BaseException):
+            raise listing_id
+        if isinstance(product_id, BaseException):
+            await db["listing"].delete_one({"_id": ObjectId(listing_id)})
+            raise product_id
+        if product_id != str(new_product_id):
+            # Lost a race with a concurrent insert of the same slug
+            await db["listing"].update_one({"_id": ObjectId(listing_id)}, {"$set": {"product_id": product_id}})
+
+    products_cache.clear()
     return {"status": "listing_created", "listing_id": listing_id, "product_id": product_id}
 
 
 # ----- Offers -----
 class OfferCreate(BaseModel):
     buyer_id: str
-    listing_id: str
+    listing_id: PyObjectId
     offer_price: float
 
 
 @app.post("/offers")
-def create_offer(payload: OfferCreate):
+async def create_offer(payload: OfferCreate):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
     # Ensure listing exists
-    listing = db["listing"].find_one({"_id": ObjectId(payload.listing_id)}) if ObjectId.is_valid(payload.listing_id) else None
+    listing = await db["listing"].find_one({"_id": payload.listing_id}, {"_id": 1})
     if not listing:
         raise HTTPException(status_code=404, detail="Listing not found")
 
     offer = Offer(
         buyer_id=payload.buyer_id,
-        listing_id=payload.listing_id,
+        listing_id=str(payload.listing_id),
         offer_price=payload.offer_price,
     )
-    offer_id = create_document("offer", offer)
+    offer_id = await create_document("offer", offer)
     return {"status": "offer_created", "offer_id": offer_id}
 
 
 # ----- Checkout / Orders -----
 class CheckoutRequest(BaseModel):
     cart_id: Optional[str] = None  # placeholder for future cart expansion
-    listing_id: str
+    listing_id: PyObjectId
     buyer_id: str
     payment_method: Dict[str, Any]
-    shipping_option: str
+    shipping_option: ShippingOption
 
 
 @app.post("/checkout")
-def checkout(payload: CheckoutRequest):
+async def checkout(payload: CheckoutRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
-    listing = db["listing"].find_one({"_id": ObjectId(payload.listing_id)}) if ObjectId.is_valid(payload.listing_id) else None
+    # Claim the listing atomically: mark it sold only if it is still active
+    # (simple flow for MVP; real escrow settles later). A null/missing status
+    # counts as active, as it always has; "active" covers unmigrated listings.
+    listing = await db["listing"].find_one_and_update(
+        {"_id": payload.listing_id, "status": {"$in": [LISTING_STATUS_CODES["active"], "active", None]}},
+        {"$set": {"status": LISTING_STATUS_CODES["sold"]}},
+        return_document=ReturnDocument.BEFORE,
+    )
     if not listing:
-        raise HTTPException(status_code=404, detail="Listing not found")
-
-    if listing.get("status") and listing["status"] != "active":
-        raise HTTPException(status_code=400, detail="Listing not available")
+        # Slow path only: tell a missing listing apart from an unavailable one
+        if await db["listing"].find_one({"_id": payload.listing_id}, {"_id": 1}) is None:
+            raise HTTPException(status_code=404, detail="Listing not found")
+        raise HTTPException(status_code=409, detail="Listing not available")
 
-    order = Order(
-        buyer_id=payload.buyer_id,
-        listing_id=str(listing["_id"]),
-        amount=float(listing["price"]),
-        currency=listing.get("currency", "USD"),
-        payment_method={k: str(v) for k, v in payload.payment_method.items()},
-        shipping_option=payload.shipping_option,
-    )
-    order_id = create_document("order", order)
+    try:
+        order = Order(
+            buyer_id=payload.buyer_id,
+            listing_id=str(listing["_id"]),
+            amount=float(listing["price"]),
+            currency=listing.get("currency", "USD"),
+            payment_method={k: str(v) for k, v in payload.payment_method.items()},
+            shipping_option=payload.shipping_option,
+        )
+        order_id = await create_document("order", order)
+    except Exception:
+        # Release the claim so the listing can still be bought
+        await db["listing"].update_one({"_id": listing["_id"]}, {"$set": {"status": LISTING_STATUS_CODES["active"]}})
+        raise
+
+    products_cache.clear()
+    return {"status": "order_confirmation", "order_id": order_id}
 
-    # Mark listing as sold (simple flow for MVP; real escrow settles later)
-    db["listing"].update_one({"_id": listing["_id"]}, {"$set": {"status": "sold"}})
 
-    return {"status": "order_confirmation", "order_id": order_id}
+# Snapshot once: /test is polled as a liveness probe
+DATABASE_URL_SET = bool(os.getenv("DATABASE_URL"))
+DATABASE_NAME_SET = bool(os.getenv("DATABASE_NAME"))
+collections_cache: TTLCache = TTLCache(maxsize=1, ttl=30)
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -220,7 +423,9 @@ def test_database():
             response["connection_status"] = "Connected"
 
             try:
-                collections = db.list_collection_names()
+                collections = collections_cache.get("names")
+                if collections is None:
+                    collections = collections_cache["names"] = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -230,9 +435,8 @@ def test_database():
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    import os as _os
-    response["database_url"] = "✅ Set" if _os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if _os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = "✅ Set" if DATABASE_URL_SET else "❌ Not Set"
+    response["database_name"] = "✅ Set" if DATABASE_NAME_SET else "❌ Not Set"
     return response
 
 
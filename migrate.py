@@ -0,0 +1,80 @@
+"""
+Data Migrations
+
+One-off backfills for documents written before a schema change.
+Every step only touches documents that still need it, so re-running is safe:
+
+    python migrate.py
+"""
+
+import asyncio
+
+from database import db
+from schemas import (
+    PRODUCT_CONDITION_CODES,
+    LISTING_TYPE_CODES,
+    LISTING_STATUS_CODES,
+    OFFER_STATUS_CODES,
+    ORDER_STATUS_CODES,
+    SHIPPING_OPTION_CODES,
+    ESCROW_STATUS_CODES,
+)
+
+# (collection, field, codes) for every enum field stored as an int code
+ENUM_FIELDS = [
+    ("product", "condition", PRODUCT_CONDITION_CODES),
+    ("listing", "listing_type", LISTING_TYPE_CODES),
+    ("listing", "status", LISTING_STATUS_CODES),
+    ("offer", "status", OFFER_STATUS_CODES),
+    ("order", "shipping_option", SHIPPING_OPTION_CODES),
+    ("order", "status", ORDER_STATUS_CODES),
+    ("order", "escrow_status", ESCROW_STATUS_CODES),
+]
+
+
+async def backfill_brand_lc():
+    """Set the normalized brand_lc filter field on products that predate it"""
+    result = await db["product"].update_many(
+        {"brand_lc": {"$exists": False}, "brand": {"$type": "string"}},
+        [{"$set": {"brand_lc": {"$trim": {"input": {"$toLower": "$brand"}}}}}],
+    )
+    return result.modified_count
+
+
+async def backfill_available_sizes():
+    """Set the distinct available_sizes filter array on products that predate it"""
+    result = await db["product"].update_many(
+        {"available_sizes": {"$exists": False}},
+        [{"$set": {"available_sizes": {"$setUnion": [{"$ifNull": ["$size_variants.size", []]}, []]}}}],
+    )
+    return result.modified_count
+
+
+async def encode_enum_fields():
+    """Rewrite enum fields stored as strings to their int codes"""
+    modified = 0
+    for collection, field, codes in ENUM_FIELDS:
+        for name, code in codes.items():
+            result = await db[collection].update_many({field: name}, {"$set": {field: code}})
+            modified += result.modified_count
+    return modified
+
+
+MIGRATIONS = [
+    backfill_brand_lc,
+    backfill_available_sizes,
+    encode_enum_fields,
+]
+
+
+async def main():
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    for migration in MIGRATIONS:
+        modified = await migration()
+        print(f"{migration.__name__}: {modified} documents updated")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
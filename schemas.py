@@ -9,11 +9,60 @@ These schemas are used for validation in API endpoints and to document the data
 
 from __future__ import annotations
 
-from pydantic import BaseModel, Field, HttpUrl, EmailStr
-from typing import List, Optional, Literal, Dict
+from pydantic import BaseModel, Field, field_validator, PlainSerializer
+from typing import Annotated, List, Optional, Literal, Dict
 from datetime import datetime
 
 
+# --- Compact enum storage ---
+# Enum-like string fields are stored in MongoDB as small ints (model_dump() in
+# python mode) and exposed as strings in JSON, so this shrinks stored documents
+# and indexes only; API payloads are unchanged. Codes are append-only: never
+# renumber an existing value. migrate.py converts documents written as strings.
+
+PRODUCT_CONDITION_CODES = {"new": 0, "used": 1, "like_new": 2, "open_box": 3}
+LISTING_TYPE_CODES = {"fixed_price": 0, "auction": 1, "make_offer": 2}
+LISTING_STATUS_CODES = {"active": 0, "sold": 1, "paused": 2, "ended": 3}
+OFFER_STATUS_CODES = {"pending": 0, "accepted": 1, "rejected": 2, "countered": 3, "expired": 4, "withdrawn": 5}
+ORDER_STATUS_CODES = {"created": 0, "paid": 1, "shipped": 2, "delivered": 3, "refunded": 4, "cancelled": 5}
+SHIPPING_OPTION_CODES = {"standard": 0, "express": 1, "store_pickup": 2, "dropship": 3}
+ESCROW_STATUS_CODES = {"held": 0, "released": 1, "refunded": 2}
+
+
+def _encode(codes: Dict[str, int]) -> PlainSerializer:
+    return PlainSerializer(lambda v, info: v if info.mode_is_json() else codes[v])
+
+
+ProductCondition = Annotated[
+    Literal["new", "used", "like_new", "open_box"],
+    _encode(PRODUCT_CONDITION_CODES),
+]
+ListingType = Annotated[
+    Literal["fixed_price", "auction", "make_offer"],
+    _encode(LISTING_TYPE_CODES),
+]
+ListingStatus = Annotated[
+    Literal["active", "sold", "paused", "ended"],
+    _encode(LISTING_STATUS_CODES),
+]
+OfferStatus = Annotated[
+    Literal["pending", "accepted", "rejected", "countered", "expired", "withdrawn"],
+    _encode(OFFER_STATUS_CODES),
+]
+OrderStatus = Annotated[
+    Literal["created", "paid", "shipped", "delivered", "refunded", "cancelled"],
+    _encode(ORDER_STATUS_CODES),
+]
+ShippingOption = Annotated[
+    Literal["standard", "express", "store_pickup", "dropship"],
+    _encode(SHIPPING_OPTION_CODES),
+]
+EscrowStatus = Annotated[
+    Literal["held", "released", "refunded"],
+    _encode(ESCROW_STATUS_CODES),
+]
+
+
 # --- Core domain schemas ---
 
 class Dimensions(BaseModel):
@@ -38,12 +87,14 @@ class Product(BaseModel):
     title: str
     slug: str
     brand: str
+    brand_lc: Optional[str] = Field(None, description="Normalized brand for exact-match filtering; set on write")
     model: str
     release_year: int
-    condition: Literal["new", "used", "like_new", "open_box"]
+    condition: ProductCondition
     size_variants: List[SizeVariant]
-    images: List[HttpUrl]
-    gallery_video: Optional[HttpUrl] = None
+    available_sizes: Optional[List[str]] = Field(None, description="Distinct variant sizes for filtering; set on write")
+    images: List[str] = Field(..., description="Absolute http(s) image URLs")
+    gallery_video: Optional[str] = Field(None, description="Absolute http(s) video URL")
     description: str
     materials: Optional[str] = None
     colorway: Optional[str] = None
@@ -55,6 +106,21 @@ class Product(BaseModel):
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
 
+    @field_validator("images")
+    @classmethod
+    def check_image_urls(cls, v: List[str]) -> List[str]:
+        # Cheap scheme check; full URL parsing is left to the uploader
+        if not all(u.startswith(("http://", "https://")) for u in v):
+            raise ValueError("images must be http(s) URLs")
+        return v
+
+    @field_validator("gallery_video")
+    @classmethod
+    def check_video_url(cls, v: Optional[str]) -> Optional[str]:
+        if v is not None and not v.startswith(("http://", "https://")):
+            raise ValueError("gallery_video must be an http(s) URL")
+        return v
+
 
 class Listing(BaseModel):
     """
@@ -64,9 +130,9 @@ class Listing(BaseModel):
     seller_id: str
     product_id: str
     price: float = Field(..., ge=0)
-    listing_type: Literal["fixed_price", "auction", "make_offer"]
+    listing_type: ListingType
     currency: str = Field("USD", min_length=3, max_length=3)
-    status: Literal["active", "sold", "paused", "ended"] = "active"
+    status: ListingStatus = "active"
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
 
@@ -80,7 +146,7 @@ class Offer(BaseModel):
     listing_id: str
     offer_price: float = Field(..., ge=0)
     currency: str = Field("USD", min_length=3, max_length=3)
-    status: Literal["pending", "accepted", "rejected", "countered", "expired", "withdrawn"] = "pending"
+    status: OfferStatus = "pending"
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
 
@@ -95,9 +161,9 @@ class Order(BaseModel):
     amount: float = Field(..., ge=0)
     currency: str = Field("USD", min_length=3, max_length=3)
     payment_method: Dict[str, str] = Field(default_factory=dict)
-    shipping_option: Literal["standard", "express", "store_pickup", "dropship"]
-    status: Literal["created", "paid", "shipped", "delivered", "refunded", "cancelled"] = "created"
-    escrow_status: Literal["held", "released", "refunded"] = "held"
+    shipping_option: ShippingOption
+    status: OrderStatus = "created"
+    escrow_status: EscrowStatus = "held"
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
 
@@ -105,5 +171,5 @@ class Order(BaseModel):
 # Auxiliary/example user schema for reference (not used directly in MVP endpoints)
 class User(BaseModel):
     name: str
-    email: EmailStr
+    email: str
     is_active: bool = True